@@ -1,15 +1,34 @@
 import os
+import sys
 # import errno
 import time
 import json
+import hashlib
+import functools
+import email.utils
+import asyncio
+import aiohttp
 import tomli
 import geopandas as gpd
+from shapely.geometry import mapping
 import requests
 import rasterio as rio
+from rasterio.enums import Resampling
 from requests.auth import HTTPBasicAuth
 import matplotlib.pyplot as plt
 import numpy as np
 import glob
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+#orjson parses large search responses much faster, fall back to json if it isn't installed
+try:
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    json_loads = json.loads
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
 
 class PlanetConfig:
     def __init__(self, config_file="config.toml"):
@@ -45,6 +64,11 @@ class PlanetConfig:
         self.max_cloud = self.config['filters']['max_cloud']
         self.start_date = self.config['filters']['start_date']
         self.end_date = self.config['filters']['end_date']
+        #shared session so TCP/TLS connections are reused across every request
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        self.session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retries))
         
     def __repr__(self) -> str:
         return (
@@ -59,6 +83,7 @@ class PlanetImages:
         self.thumb_dir = os.path.join('data', 'imagery', f'{self.config.project_name}', f'{self.date_folder}', 'thumbnails')
         self.img_dir = os.path.join('data', 'imagery', f'{self.config.project_name}', f'{self.date_folder}')
         self.search_json = {}
+        self.cache_dir = '.cache'
         self.img_count = 0
         self.image_ids = []
         self.image_list = []
@@ -68,16 +93,58 @@ class PlanetImages:
         self.active_imgs = []
         self.all_imgs_active = False
         self.downloaded_imgs = []
+        self._existing_imgs = set()
+        #img_id -> (time fetched, asset json)
+        self._asset_cache = {}
+        #the quick-search body only depends on the config, so build it once
+        self._search_body = self._build_search_body()
     
-    def _load_aoi(self):
+    @staticmethod
+    def _downloaded_ids(directory) -> set:
+        #ids of the .tif files already in a directory, using one scan
+        try:
+            with os.scandir(directory) as entries:
+                return {e.name[:-4] for e in entries if e.name.endswith('.tif')}
+        except FileNotFoundError:
+            return set()
+
+    def _get_assets(self, img_id, ttl=20):
+        cached = self._asset_cache.get(img_id)
+        if cached and time.monotonic() - cached[0] < ttl:
+            return cached[1]
+        asset_url = f'https://api.planet.com/data/v1/item-types/{self.config.ITEM_TYPE}/items/{img_id}/assets'
+        result = self.config.session.get(asset_url)
+        #don't cache error bodies as if they were asset listings
+        result.raise_for_status()
+        assets = json_loads(result.content)
+        self._asset_cache[img_id] = (time.monotonic(), assets)
+        return assets
+
+    @functools.cached_property
+    def _aoi_coords(self):
+        #read the mask once and take the geometry directly, no GeoJSON round trip
         aoi_geom = gpd.read_file(self.config.mask)
-        aoi_geom = aoi_geom.to_json()
-        aoi_geom = json.loads(aoi_geom)
-        aoi_coords = aoi_geom['features'][0]['geometry']
-        return aoi_coords
+        return mapping(aoi_geom.geometry.iloc[0])
     
-    def search_for_images(self):
-        aoi = self._load_aoi()
+    def _cached_post(self, url, body, ttl=3600):
+        #cache responses on disk keyed by a hash of the request body
+        key = hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()
+        cache_file = os.path.join(self.cache_dir, f'{key}.json')
+        if os.path.exists(cache_file) and time.time() - os.path.getmtime(cache_file) < ttl:
+            with open(cache_file, 'rb') as f:
+                return json_loads(f.read())
+        result = self.config.session.post(url, data=json_dumps(body), headers=self.config.headers)
+        result.raise_for_status()
+        result_json = json_loads(result.content)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_file = f'{cache_file}.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(json_dumps(result_json))
+        os.replace(tmp_file, cache_file)
+        return result_json
+
+    def _build_search_body(self):
+        aoi = self._aoi_coords
         #set start and end dates
         start_date = self.config.start_date + 'T00:00:00.000Z'
         end_date = self.config.end_date + 'T00:00:00.000Z'
@@ -118,10 +185,13 @@ class PlanetImages:
         "item_types": [self.config.ITEM_TYPE], 
         "filter": combined_filter
         }
-        search_result = requests.post(
-            self.config.SEARCH_URL,
-            auth=HTTPBasicAuth(self.config.API_KEY, ''), json=search_request)
-        self.search_json = search_result.json()
+        return search_request
+
+    def search_for_images(self):
+        #reuse the search already done this run
+        if self.search_json:
+            return self.search_json
+        self.search_json = self._cached_post(self.config.SEARCH_URL, self._search_body)
         return self.search_json
     
     def get_all_avail_image_ids(self):
@@ -135,15 +205,17 @@ class PlanetImages:
         image_json = self.search_for_images()
         self.image_list = []
         self.unique_dates = []
+        downloaded_imgs = self._downloaded_ids(self.img_dir)
+        seen_dates = set()
         #loop through all images, get unique date, and return image info/feature info
         if self.config.unique_dates_only == 'True':
             for feature in image_json['features']:
                 image_id = feature['id']
                 #check if image has been downloaded already
-                downloaded_img = glob.glob(f'{self.img_dir}/{image_id}.tif')
-                if not downloaded_img:
+                if image_id not in downloaded_imgs:
                     date = image_id[0:8]
-                    if date not in self.unique_dates:
+                    if date not in seen_dates:
+                        seen_dates.add(date)
                         self.unique_dates.append(date)
                         self.image_list.append(feature)
                 else:
@@ -152,8 +224,7 @@ class PlanetImages:
             #check if image downloaded and download all remaining images
             for feature in image_json['features']:
                 image_id = feature['id']
-                downloaded_img = glob.glob(f'{self.img_dir}/{image_id}.tif')
-                if not downloaded_img:
+                if image_id not in downloaded_imgs:
                     self.image_list.append(feature)
                 else:
                     print(f'Skipping image {image_id} -- already downloaded')
@@ -163,31 +234,75 @@ class PlanetImages:
         else:
             raise ValueError("Image list is empty. Try a new date, location, or filters.")
 
+    async def _adownload_thumb(self, session, image):
+        thumb_url = image['_links']['thumbnail']
+        img_id = image['id']
+        thumb_path = f'{self.thumb_dir}/{img_id}.tif'
+        tmp_path = f'{self.thumb_dir}/.{img_id}.tif.part'
+        try:
+            async with session.get(thumb_url) as thumb_req:
+                thumb_req.raise_for_status()
+                with open(tmp_path, 'wb') as f:
+                    while True:
+                        chunk = await thumb_req.content.read(64 * 1024)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+            os.replace(tmp_path, thumb_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    async def _adownload_thumbs(self, image_list, tasks_count=32):
+        queue = asyncio.Queue()
+        for image in image_list:
+            queue.put_nowait(image)
+
+        async def worker(session):
+            while True:
+                image = await queue.get()
+                try:
+                    await self._adownload_thumb(session, image)
+                except Exception as e:
+                    #keep the worker alive so one bad thumbnail can't stall the queue
+                    print(f"Couldn't download thumbnail for {image.get('id')}: {e!r}")
+                finally:
+                    queue.task_done()
+
+        auth = aiohttp.BasicAuth(self.config.API_KEY, '')
+        connector = aiohttp.TCPConnector(limit=tasks_count)
+        async with aiohttp.ClientSession(auth=auth, connector=connector) as session:
+            workers = [asyncio.create_task(worker(session)) for _ in range(tasks_count)]
+            await queue.join()
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
     def download_image_thumbnails(self) -> None:
-        image_list = self.image_list
         if not os.path.exists(self.thumb_dir):
             os.makedirs(self.thumb_dir)
-        for image in image_list:
-            thumb_url = image['_links']['thumbnail']
-            img_id = image['id']
-            thumb_req = requests.get(thumb_url, auth=HTTPBasicAuth(self.config.API_KEY, ''))
-            downloaded_thumb = glob.glob(f'{self.thumb_dir}/{img_id}.tif')
-            if not downloaded_thumb:
-                # print(f"Downloading thumbnail for {img_id}")
-                open(f'{self.thumb_dir}/{img_id}.tif', 'wb').write(thumb_req.content)
-            else:
-                pass
+        #only request thumbnails that aren't on disk yet
+        downloaded_thumbs = self._downloaded_ids(self.thumb_dir)
+        image_list = [i for i in self.image_list if i['id'] not in downloaded_thumbs]
+        if image_list:
+            asyncio.run(self._adownload_thumbs(image_list))
+
+    @staticmethod
+    def _band_means(image):
+        with rio.open(image) as src:
+            #a 64x64 sample per band is plenty for the quality check
+            out_shape = (src.count, min(src.height, 64), min(src.width, 64))
+            arr = src.read(out_shape=out_shape, resampling=Resampling.nearest)
+        #one pass over the pixel buffer for all band means
+        return image, arr.reshape(arr.shape[0], -1).mean(axis=1)
 
     def filter_images_for_quality(self) -> list:
         thumb_imgs = glob.glob(f'{self.thumb_dir}/*.tif')
         self.good_imgs = []
-        for image in thumb_imgs:
-            with rio.open(image) as src:
-                b, g, r, nir = src.read()
-                # b_mean = b.mean()
-                # g_mean = g.mean()
-                r_mean = r.mean()
-                nir_mean = nir.mean()
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            for image, means in ex.map(self._band_means, thumb_imgs):
+                b_mean, g_mean, r_mean, nir_mean = means
                 if nir_mean >= 100 and r_mean < 10:
                     print(f'{image} is possibly bad and/or corrupted. Double check before downloading.')
                 else:
@@ -200,70 +315,152 @@ class PlanetImages:
         self.imgs_to_download = [i for i in self.search_json['features'] if i['id'] in img_base_names]
         return self.imgs_to_download
 
+    def _activate_one(self, i):
+        img_id = i['id']
+        try:
+            assets = self._get_assets(img_id)
+            img_status = assets[f'{self.config.IMAGE_TYPE}']['status']
+            if img_status == 'inactive':
+                print(f'Image {img_id} is inactive. Attempting to activate.')
+                links = assets[f'{self.config.IMAGE_TYPE}']["_links"]
+                # self_link = links["_self"]
+                activation_link = links["activate"]
+                # Request activation of the 'analytic' asset:
+                activate_result = self.config.session.get(activation_link)
+                activate_result.raise_for_status()
+                #cached status is stale once activation is requested
+                self._asset_cache.pop(img_id, None)
+            elif img_status == 'active':
+                print(f'Image {img_id} is already active.')
+            else:
+                print(f'Unknown status for image {img_id}')
+            return img_id, img_status
+        except KeyError:
+            print(f'Image type {self.config.IMAGE_TYPE} not available for {img_id}')
+            print(f'Removing image {img_id} from download list.')
+            print(f'These other images are available for {img_id}: {assets.keys()}')
+            return img_id, None
+        except (requests.RequestException, ValueError) as e:
+            #http errors, exhausted retries, or a non-JSON body only fail this image
+            print(f'Could not activate image {img_id}: {e!r}')
+            print(f'Removing image {img_id} from download list.')
+            return img_id, None
+
     def activate_imgs(self):
-        for i in self.imgs_to_download:
-            img_id = i['id']
-            img_links = i['_links']
-            # dwn_link = img_links['_self']
-            asset_url = f'https://api.planet.com/data/v1/item-types/{self.config.ITEM_TYPE}/items/{img_id}/assets'
-            try:
-                result = \
-                requests.get(
-                    asset_url,
-                    auth=HTTPBasicAuth(self.config.API_KEY, '')
-                )
-                img_status = result.json()[f'{self.config.IMAGE_TYPE}']['status']
-                if img_status == 'inactive':
-                    print(f'Image {img_id} is inactive. Attempting to activate.')
-                    links = result.json()[f'{self.config.IMAGE_TYPE}']["_links"]
-                    # self_link = links["_self"]
-                    activation_link = links["activate"]
-                    # Request activation of the 'analytic' asset:
-                    activate_result = \
-                    requests.get(
-                        activation_link,
-                        auth=HTTPBasicAuth(self.config.API_KEY, '')
-                    )
-                elif img_status == 'active':
-                    print(f'Image {img_id} is already active.')
-                else:
-                    print(f'Unknown status for image {img_id}')
-                    self.imgs_to_download.remove(i)
-            except KeyError:
-                print(f'Image type {self.config.IMAGE_TYPE} not available for {img_id}')
-                print(f'Removing image {img_id} from download list.')
-                print(f'These other images are available for {img_id}: {result.json().keys()}')
-                self.imgs_to_download.remove(i)
+        with ThreadPoolExecutor(max_workers=16) as ex:
+            statuses = dict(ex.map(self._activate_one, self.imgs_to_download))
+        #drop images with unknown status or missing asset type in one pass
+        self.imgs_to_download = [i for i in self.imgs_to_download if statuses[i['id']] in ('inactive', 'active')]
+        return statuses
         
+    @staticmethod
+    def _parse_retry_after(value, max_delay=60) -> float:
+        #Retry-After can be seconds or an HTTP date, 0 means no usable hint
+        if not value:
+            return 0
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(value)
+                delay = retry_at.timestamp() - time.time()
+            except (TypeError, ValueError):
+                return 0
+        #guard against nan/inf and far-future hints
+        if not delay > 0:
+            return 0
+        return min(delay, max_delay)
+
+    async def _apoll_status(self, session, image):
+        asset_url = image['_links']['assets']
+        try:
+            async with session.get(asset_url) as result:
+                if result.status == 429 or result.status >= 500:
+                    #rate limited or server error, leave pending and retry next round
+                    print(f"Status check for image {image['id']} returned {result.status}, retrying.")
+                    return image, None, self._parse_retry_after(result.headers.get('Retry-After'))
+                if result.status >= 300:
+                    #bad key, missing item, etc. -- retrying won't help
+                    print(f"Status check for image {image['id']} returned {result.status}, giving up on it.")
+                    return image, 'error', 0
+                result_json = json_loads(await result.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Couldn't check status for image {image['id']}: {e!r}")
+            return image, None, 0
+        img_status = result_json[f'{self.config.IMAGE_TYPE}']['status']
+        #replace any stale cached assets with the latest status
+        self._asset_cache[image['id']] = (time.monotonic(), result_json)
+        return image, img_status, 0
+
+    async def _acheck_if_images_active(self, max_wait=630, max_connections=32):
+        pending = {i['id']: i for i in self.imgs_to_download if i not in self.active_imgs}
+        backoff = 5
+        waited = 0
+        auth = aiohttp.BasicAuth(self.config.API_KEY, '')
+        #cap concurrent status requests so polling doesn't trigger rate limits itself
+        connector = aiohttp.TCPConnector(limit=max_connections)
+        async with aiohttp.ClientSession(auth=auth, connector=connector) as session:
+            while pending:
+                results = await asyncio.gather(*[self._apoll_status(session, i) for i in pending.values()])
+                retry_after = 0
+                for image, img_status, retry in results:
+                    retry_after = max(retry_after, retry)
+                    if img_status == 'failed':
+                        raise Exception(f"Activation failed for image {image['id']}")
+                    elif img_status == 'active':
+                        self.active_imgs.append(image)
+                        del pending[image['id']]
+                    elif img_status == 'error':
+                        del pending[image['id']]
+                if not pending or waited >= max_wait:
+                    break
+                #honor Retry-After from rate limiting, otherwise back off exponentially
+                delay = min(max(backoff, retry_after), max_wait - waited)
+                await asyncio.sleep(delay)
+                waited += delay
+                backoff = min(backoff * 2, 60)
+        return pending
+
     def check_if_images_active(self):
         # check to see if product is active or not
-        num_loops = 21
-        count = 0
-        while(count < num_loops):
-            for i in self.imgs_to_download:
-                ##TODO clean up request here to not repeat all images.
-                ##TODO make new list of inactive images to request from
-                # img_id = i['id']
-                img_links = i['_links']
-                asset_url = img_links['assets']
-                # self_link = img_links['_self']
-                result = \
-                    requests.get(
-                        asset_url,
-                        auth=HTTPBasicAuth(self.config.API_KEY, '')
-                    )
-                img_status = result.json()[f'{self.config.IMAGE_TYPE}']['status']   
-                success_states = ['active']
-                if img_status == 'failed':
-                    raise Exception()
-                elif img_status in success_states and i not in self.active_imgs:
-                    self.active_imgs.append(i)
-            count += 1
-            if len(self.active_imgs) == len(self.imgs_to_download):
-                print('All images ready to download.')
-                self.all_imgs_active = True
-                break
-            time.sleep(30)
+        pending = asyncio.run(self._acheck_if_images_active())
+        if not pending and len(self.active_imgs) == len(self.imgs_to_download):
+            print('All images ready to download.')
+            self.all_imgs_active = True
+
+    def _download_one(self, image):
+        img_id = image['id']
+        if img_id in self._existing_imgs:
+            print(f'Image {img_id} already downloaded -- skipping.')
+            return img_id, True
+        tmp_path = f'{self.img_dir}/.{img_id}.tif.part'
+        try:
+            #get the asset info
+            assets = self._get_assets(img_id)
+            #get different _self link for these assets
+            links = assets[f'{self.config.IMAGE_TYPE}']['_links']
+            self_link = links['_self']
+            self_req = self.config.session.get(self_link)
+            download_url = json_loads(self_req.content)["location"]
+            print(f"Downloading image {img_id}.")
+            img_path = f'{self.img_dir}/{img_id}.tif'
+            with self.config.session.get(download_url, stream=True) as img_req, open(tmp_path, 'wb') as f:
+                img_req.raise_for_status()
+                shutil.copyfileobj(img_req.raw, f, length=65536)
+                #raw.read doesn't enforce Content-Length, so catch a dropped connection here
+                expected = img_req.headers.get('Content-Length')
+                if expected is not None and f.tell() != int(expected):
+                    raise IOError(f'Incomplete download for {img_id}: got {f.tell()} of {expected} bytes')
+            #only expose the final name once the whole file is written
+            os.replace(tmp_path, img_path)
+            self.downloaded_imgs.append(img_id)
+            return img_id, True
+        except:
+            #never leave a partial file behind
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            print(f'Something went wrong downloading image {img_id}: {sys.exc_info()[1]!r}')
+            return img_id, False
 
     def download_images(self):
         if self.all_imgs_active == True:
@@ -271,39 +468,13 @@ class PlanetImages:
         else:
             print('All images may not be active. Downloading those that are.')
             print('You may want to run this script again after.')
-        ###TODO repeating a lot of requests. Clean this up later and implement other requests above.
         ###TODO mainly there are 2 '_self' links and both are needed. The first is needed to get download link.
-        for image in self.active_imgs:
-            #go through all active images
-            img_id = image['id']
-            asset_url = f'https://api.planet.com/data/v1/item-types/{self.config.ITEM_TYPE}/items/{img_id}/assets'
-            downloaded_img = glob.glob(f'{self.img_dir}/{img_id}.tif')
-            if not downloaded_img:
-                try:
-                    #get the asset info
-                    result = \
-                    requests.get(
-                        asset_url,
-                        auth=HTTPBasicAuth(self.config.API_KEY, '')
-                    )
-                    #get different _self link for these assets
-                    links = result.json()[f'{self.config.IMAGE_TYPE}']['_links']
-                    self_link = links['_self']
-                    self_req = \
-                        requests.get(
-                        self_link,
-                        auth=HTTPBasicAuth(self.config.API_KEY, '')
-                    )
-                    download_url = self_req.json()["location"]
-                    img_req = requests.get(download_url, auth=HTTPBasicAuth(self.config.API_KEY, ''))
-
-                    print(f"Downloading image {img_id}.")
-                    open(f'{self.img_dir}/{img_id}.tif', 'wb').write(img_req.content)
-                except:
-                    print('Something went wrong.')
-            else:
-                print(f'Image {img_id} already downloaded -- skipping.')
-
+        if not os.path.exists(self.img_dir):
+            os.makedirs(self.img_dir)
+        self._existing_imgs = self._downloaded_ids(self.img_dir)
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            results = list(ex.map(self._download_one, self.active_imgs))
+        return results
 
 def main():
     plan_imgs = PlanetImages()